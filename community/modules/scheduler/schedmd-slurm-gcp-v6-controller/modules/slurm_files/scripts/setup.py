@@ -18,13 +18,15 @@
 import argparse
 import logging
 import os
+import random
+import re
 import shutil
 import subprocess
-import stat
 import time
 import yaml
 from pathlib import Path
 import functools
+from typing import Iterator
 
 import util
 from util import (
@@ -34,14 +36,17 @@ from util import (
     run,
     install_custom_scripts,
 )
-import conf
-import slurmsync
 
 from setup_network_storage import (
     setup_network_storage,
     setup_nfs_exports,
 )
 
+try: # prefer LibYAML bindings when available
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper # type: ignore
+
 
 log = logging.getLogger()
 
@@ -85,27 +90,42 @@ SSSSSSSSSSSS    SSS    SSSSSSSSSSSSS    SSSS        SSSS     SSSS     SSSS
 
 """
 _MAINTENANCE_SBATCH_SCRIPT_PATH = dirs.custom_scripts / "perform_maintenance.sh"
+# passwd/group lines in nsswitch.conf that don't list slurm first yet
+_NSS_SLURM_RE = re.compile(r"^((?:passwd|group):[ \t]+)(?![ \t]|slurm\b)", re.M)
+_MOTD_PATH = Path("/etc/motd")
+
+
+def _atomic_write(path: Path, data: str) -> None:
+    """replace file content without exposing a truncated file to readers"""
+    path = path.resolve() # write through symlinks, e.g. motd managed elsewhere
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_text(data)
+    if path.exists():
+        shutil.copymode(path, tmp) # new inode would otherwise get the umask default
+    os.replace(tmp, path)
+
 
 def start_motd():
     """advise in motd that slurm is currently configuring"""
     wall_msg = "*** Slurm is currently being configured in the background. ***"
     motd_msg = MOTD_HEADER + wall_msg + "\n\n"
-    Path("/etc/motd").write_text(motd_msg)
+    _atomic_write(_MOTD_PATH, motd_msg)
     util.run(f"wall -n '{wall_msg}'", timeout=30)
 
 
 def end_motd(broadcast=True):
     """modify motd to signal that setup is complete"""
-    Path("/etc/motd").write_text(MOTD_HEADER)
+    _atomic_write(_MOTD_PATH, MOTD_HEADER)
 
     if not broadcast:
         return
 
+    lkp = lookup()
     run(
-        "wall -n '*** Slurm {} setup complete ***'".format(lookup().instance_role),
+        "wall -n '*** Slurm {} setup complete ***'".format(lkp.instance_role),
         timeout=30,
     )
-    if not lookup().is_controller:
+    if not lkp.is_controller:
         run(
             """wall -n '
 /home on the controller was mounted over the existing /home.
@@ -119,7 +139,7 @@ def failed_motd():
     """modify motd to signal that setup is failed"""
     wall_msg = f"*** Slurm setup failed! Please view log: {util.get_log_path()} ***"
     motd_msg = MOTD_HEADER + wall_msg + "\n\n"
-    Path("/etc/motd").write_text(motd_msg)
+    _atomic_write(_MOTD_PATH, motd_msg)
     util.run(f"wall -n '{wall_msg}'", timeout=30)
 
 
@@ -133,32 +153,48 @@ def _startup_script_timeout(lkp: util.Lookup) -> int:
     return 300
 
 
+def _iter_scripts(root: Path) -> Iterator[Path]:
+    """yield enabled files under root, uses DirEntry type info to avoid a stat per entry"""
+    stack = [root]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        subdirs = []
+        with it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    subdirs.append(Path(e.path))
+                elif e.is_file() and not e.name.endswith(".disabled"):
+                    yield Path(e.path)
+        # reversed so subdirectories are visited in scandir order, same as rglob
+        stack.extend(reversed(subdirs))
+
+
 def run_custom_scripts():
     """run custom scripts based on instance_role"""
+    lkp = lookup()
     custom_dir = dirs.custom_scripts
-    if lookup().is_controller:
+    if lkp.is_controller:
         # controller has all scripts, but only runs controller.d
         custom_dirs = [custom_dir / "controller.d"]
-    elif lookup().instance_role == "compute":
+    elif lkp.instance_role == "compute":
         # compute setup with nodeset.d
         custom_dirs = [custom_dir / "nodeset.d"]
-    elif lookup().is_login_node:
+    elif lkp.is_login_node:
         # login setup with only login.d
         custom_dirs = [custom_dir / "login.d"]
     else:
         # Unknown role: run nothing
         custom_dirs = []
 
-    timeout = _startup_script_timeout(lookup())
+    timeout = _startup_script_timeout(lkp)
 
-    custom_scripts = [
-        p
-        for d in custom_dirs
-        for p in d.rglob("*")
-        if p.is_file() and not p.name.endswith(".disabled")
-    ]
-    print_scripts = ",".join(str(s.relative_to(custom_dir)) for s in custom_scripts)
-    log.debug(f"custom scripts to run: {custom_dir}/({print_scripts})")
+    custom_scripts = [p for d in custom_dirs for p in _iter_scripts(d)]
+    if log.isEnabledFor(logging.DEBUG):
+        print_scripts = ",".join(str(s.relative_to(custom_dir)) for s in custom_scripts)
+        log.debug(f"custom scripts to run: {custom_dir}/({print_scripts})")
 
     try:
         for script in custom_scripts:
@@ -180,24 +216,51 @@ def run_custom_scripts():
         log.exception(f"script {script} encountered an exception")
         raise e
 
+
+def ensure_fstab_entries(entries: list[str], fstab: Path = Path("/etc/fstab")) -> bool:
+    """Append missing entries to /etc/fstab, returns True if any were added.
+    Callers are expected to daemon-reload once after all their fstab changes."""
+    existing = set()
+    last = "\n"
+    with open(fstab, "r") as f:
+        for last in f:
+            # compare whitespace-normalized, fstab fields may be separated by any run of blanks
+            existing.add(" ".join(last.split()))
+    missing = [e for e in entries if " ".join(e.split()) not in existing]
+    if not missing:
+        return False
+
+    # don't glue the first new entry onto a last line lacking its newline
+    prefix = "" if last.endswith("\n") else "\n"
+    with open(fstab, "a") as f:
+        f.write(prefix + "\n".join(missing) + "\n")
+    return True
+
+
 def mount_save_state_disk():
     disk_name = f"/dev/disk/by-id/google-{lookup().cfg.controller_state_disk.device_name}"
     mount_point = util.slurmdirs.state
     fs_type = "ext4"
 
-    rdevice = util.run(f"realpath {disk_name}").stdout.strip()
-    file_output = util.run(f"file -s {rdevice}").stdout.strip()
-    if "filesystem" not in file_output:
+    rdevice = os.path.realpath(disk_name)
+    # blkid exits with 2 when no filesystem is found, which is expected on first boot,
+    # so bypass run() to not log it as an error; anything else is a real failure
+    try:
+        probe = subprocess.run(
+            ["blkid", "-o", "value", "-s", "TYPE", rdevice],
+            capture_output=True, text=True, timeout=30,
+        )
+    except subprocess.TimeoutExpired as e:
+        util.log_subprocess(e)
+        raise
+    if probe.returncode == 2:
         util.run(f"mkfs -t {fs_type} -q {rdevice}")
+    elif probe.returncode != 0:
+        util.log_subprocess(probe)
+        probe.check_returncode()
 
-    fstab_entry = f"{disk_name} {mount_point} {fs_type}"
-    with open("/etc/fstab", "r") as f:
-        fstab = f.readlines()
-    if fstab_entry not in fstab:
-        with open("/etc/fstab", "a") as f:
-            f.write(f"{fstab_entry} defaults 0 0\n")
-
-    util.run(f"systemctl daemon-reload")
+    if ensure_fstab_entries([f"{disk_name} {mount_point} {fs_type} defaults 0 0"]):
+        util.run("systemctl daemon-reload")
 
     os.makedirs(mount_point, exist_ok=True)
     util.run(f"mount {mount_point}")
@@ -211,13 +274,13 @@ def setup_jwt_key():
     if jwt_key.exists():
         log.info("JWT key already exists. Skipping key generation.")
     else:
-        run("dd if=/dev/urandom bs=32 count=1 > " + str(jwt_key), shell=True)
+        jwt_key.write_bytes(os.urandom(32))
 
     util.chown_slurm(jwt_key, mode=0o400)
 
 
 def _generate_key(p: Path) -> None:
-    run(f"dd if=/dev/random of={p} bs=1024 count=1")
+    p.write_bytes(os.urandom(1024))
 
 
 def setup_key(lkp: util.Lookup) -> None:
@@ -242,7 +305,7 @@ def setup_key(lkp: util.Lookup) -> None:
             util.chown_slurm(persist, mode=0o400)
         else:
             shutil.chown(dst, user="munge", group="munge")
-            os.chmod(dst, stat.S_IRUSR)
+            os.chmod(dst, 0o400)
     else:
         if dst.exists():
             log.info("key already exists. Skipping key generation.")
@@ -252,7 +315,7 @@ def setup_key(lkp: util.Lookup) -> None:
               util.chown_slurm(dst, mode=0o400)
             else:
               shutil.chown(dst, user="munge", group="munge")
-              os.chmod(dst, stat.S_IRUSR)
+              os.chmod(dst, 0o400)
 
     if lkp.cfg.enable_slurm_auth:
         # Put key into shared volume for distribution
@@ -268,13 +331,19 @@ def setup_nss_slurm():
     """install and configure nss_slurm"""
     # setup nss_slurm
     util.mkdirp(Path("/var/spool/slurmd"))
-    run(
-        "ln -s {}/lib/libnss_slurm.so.2 /usr/lib64/libnss_slurm.so.2".format(
-            slurmdirs.prefix
-        ),
-        check=False,
-    )
-    run(r"sed -i 's/\(^\(passwd\|group\):\s\+\)/\1slurm /g' /etc/nsswitch.conf")
+    try:
+        os.symlink(
+            f"{slurmdirs.prefix}/lib/libnss_slurm.so.2", "/usr/lib64/libnss_slurm.so.2"
+        )
+    except FileExistsError:
+        pass
+    except OSError as e:
+        log.warning(f"Failed to link libnss_slurm: {e}")
+    nsswitch = Path("/etc/nsswitch.conf")
+    text = nsswitch.read_text()
+    new = _NSS_SLURM_RE.sub(r"\1slurm ", text)
+    if new != text:
+        nsswitch.write_text(new)
 
 
 def setup_sudoers():
@@ -329,8 +398,12 @@ def configure_mysql():
     cnfdir = Path("/etc/my.cnf.d")
     if not cnfdir.exists():
         cnfdir = Path("/etc/mysql/conf.d")
-    if not (cnfdir / "mysql_slurm.cnf").exists():
-        (cnfdir / "mysql_slurm.cnf").write_text(
+    cnf = cnfdir / "mysql_slurm.cnf"
+    if cnf.exists():
+        # keep existing config (e.g. tuned by a custom script), only make sure it's running
+        run("systemctl enable --now mariadb", timeout=30)
+    else:
+        cnf.write_text(
             """
 [mysqld]
 bind-address=127.0.0.1
@@ -339,37 +412,58 @@ innodb_log_file_size=64M
 innodb_lock_wait_timeout=900
 """
         )
-    run("systemctl enable mariadb", timeout=30)
-    run("systemctl restart mariadb", timeout=30)
-
-    mysql, host = "mysql -u root -e", lookup().control_host
-    run(f"""{mysql} "drop user if exists 'slurm'@'localhost'";""", timeout=30)
-    run(f"""{mysql} "create user 'slurm'@'localhost'";""", timeout=30)
-    run(f"""{mysql} "grant all on slurm_acct_db.* TO 'slurm'@'localhost'";""", timeout=30)
-    run(f"""{mysql} "drop user if exists 'slurm'@'{host}'";""", timeout=30)
-    run(f"""{mysql} "create user 'slurm'@'{host}'";""", timeout=30)
-    run(f"""{mysql} "grant all on slurm_acct_db.* TO 'slurm'@'{host}'";""", timeout=30)
+        run("systemctl enable mariadb", timeout=30)
+        run("systemctl restart mariadb", timeout=30)
+
+    # single client session for all statements, instead of one mysql process each
+    stmts = []
+    for host in ("localhost", lookup().control_host):
+        stmts += [
+            f"drop user if exists 'slurm'@'{host}';",
+            f"create user 'slurm'@'{host}';",
+            f"grant all on slurm_acct_db.* TO 'slurm'@'{host}';",
+        ]
+    run("mysql -u root", input="\n".join(stmts), timeout=60)
+
+
+def _copy_executable(src: Path, dst: Path) -> None:
+    """copy file in-kernel via copy_file_range and make it executable"""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                pass
+        except OSError: # e.g. not supported by the filesystem, start over
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst)
+        os.fchmod(fdst.fileno(), 0o755)
 
 
 def configure_dirs():
-    for p in dirs.values():
-        util.mkdirp(p)
-
-    for p in (dirs.slurm, dirs.scripts, dirs.custom_scripts):
-        util.chown_slurm(p)
+    # path -> whether it should be owned by slurm
+    targets = {p: False for p in dirs.values()}
+    for p in (dirs.slurm, dirs.scripts, dirs.custom_scripts, *slurmdirs.values()):
+        targets[p] = True
 
-    for p in slurmdirs.values():
+    for p, chown in targets.items():
         util.mkdirp(p)
-        util.chown_slurm(p)
+        if chown:
+            util.chown_slurm(p)
 
     for sl, tgt in ( # create symlinks
         (Path("/etc/slurm"), slurmdirs.etc),
         (dirs.scripts / "etc", slurmdirs.etc),
         (dirs.scripts / "log", dirs.log),
     ):
-        if sl.exists() and sl.is_symlink():
-            sl.unlink()
-        sl.symlink_to(tgt)
+        try:
+            sl.symlink_to(tgt)
+        except FileExistsError:
+            if not sl.is_symlink():
+                raise
+            if os.readlink(sl) != str(tgt):
+                sl.unlink()
+                sl.symlink_to(tgt)
 
     # copy auxiliary scripts
     for dst_folder, src_file in ((lookup().cfg.slurm_bin_dir,
@@ -380,8 +474,7 @@ def configure_dirs():
                                   Path("tools/task-epilog"))):
         dst = Path(dst_folder) / src_file.name
         util.mkdirp(dst.parent)
-        shutil.copyfile(util.scripts_dir / src_file, dst)
-        os.chmod(dst, 0o755)
+        _copy_executable(util.scripts_dir / src_file, dst)
 
 
 def self_report_controller_address(lkp: util.Lookup) -> None:
@@ -395,8 +488,12 @@ def self_report_controller_address(lkp: util.Lookup) -> None:
 
 def setup_controller():
     """Run controller setup"""
+    # controller-only deps, they pull in tpu & cloud clients that compute/login don't need
+    import conf
+    import slurmsync
+
     log.info("Setting up controller")
-    lkp = util.lookup()
+    lkp = lookup()
     util.chown_slurm(dirs.scripts / "config.yaml", mode=0o600)
     install_custom_scripts()
     conf.gen_controller_configs(lkp)
@@ -430,33 +527,29 @@ def setup_controller():
     elif result.returncode > 1:
         result.check_returncode()  # will raise error
 
-    run("systemctl enable slurmctld", timeout=30)
-    run("systemctl restart slurmctld", timeout=30)
-
-    run("systemctl enable slurmrestd", timeout=30)
-    run("systemctl restart slurmrestd", timeout=30)
+    run("systemctl enable slurmctld slurmrestd nfs-server", timeout=30)
+    util.run_parallel([
+        "systemctl restart slurmctld",
+        "systemctl restart slurmrestd",
+        "systemctl start nfs-server",
+    ])
 
     # Export at the end to signal that everything is up
-    run("systemctl enable nfs-server", timeout=30)
-    run("systemctl start nfs-server", timeout=30)
-
     setup_nfs_exports()
     run("systemctl enable --now slurmcmd.timer", timeout=30)
 
     log.info("Check status of cluster services")
+    services = "slurmdbd slurmctld slurmrestd"
     if not lkp.cfg.enable_slurm_auth:
-      run("systemctl status munge", timeout=30)
-    run("systemctl status slurmdbd", timeout=30)
-    run("systemctl status slurmctld", timeout=30)
-    run("systemctl status slurmrestd", timeout=30)
+      services = f"munge {services}"
+    run(f"systemctl status {services}", timeout=30)
 
     try:
         slurmsync.sync_instances()
     except Exception:
         log.exception("Failed to sync instances, will try next time.")
 
-    run("systemctl enable slurm_load_bq.timer", timeout=30)
-    run("systemctl start slurm_load_bq.timer", timeout=30)
+    run("systemctl enable --now slurm_load_bq.timer", timeout=30)
     run("systemctl status slurm_load_bq.timer", timeout=30)
 
     # Add script to perform maintenance
@@ -468,16 +561,20 @@ def setup_controller():
     pass
 
 
+def _slurmctld_host(lkp: util.Lookup) -> str:
+    """controller host for --conf-server, with address if it's set"""
+    if lkp.control_addr:
+        return f"{lkp.control_host}({lkp.control_addr})"
+    return f"{lkp.control_host}"
+
+
 def setup_login():
     """run login node setup"""
     log.info("Setting up login")
 
     lkp = lookup()
-    slurmctld_host = f"{lkp.control_host}"
-    if lkp.control_addr:
-        slurmctld_host = f"{lkp.control_host}({lkp.control_addr})"
     sackd_options = [
-        f'--conf-server="{slurmctld_host}:{lkp.control_host_port}"',
+        f'--conf-server="{_slurmctld_host(lkp)}:{lkp.control_host_port}"',
     ]
     sysconf = f"""SACKD_OPTIONS='{" ".join(sackd_options)}'"""
     update_system_config("sackd", sysconf)
@@ -494,24 +591,33 @@ def setup_login():
     run_custom_scripts()
 
     log.info("Check status of cluster services")
+    services = "sackd"
     if not lkp.cfg.enable_slurm_auth:
-      run("systemctl status munge", timeout=30)
-    run("systemctl status sackd", timeout=30)
+      services = f"munge {services}"
+    run(f"systemctl status {services}", timeout=30)
 
     log.info("Done setting up login")
 
 
+def _has_nvidia_gpu() -> bool:
+    """check PCI vendor ids for NVIDIA (0x10de)"""
+    for vendor in Path("/sys/bus/pci/devices").glob("*/vendor"):
+        try:
+            if vendor.read_text().strip().lower() == "0x10de":
+                return True
+        except OSError:
+            pass
+    return False
+
+
 def setup_compute():
     """run compute node setup"""
     log.info("Setting up compute")
 
     lkp = lookup()
     util.chown_slurm(dirs.scripts / "config.yaml", mode=0o600)
-    slurmctld_host = f"{lkp.control_host}"
-    if lkp.control_addr:
-        slurmctld_host = f"{lkp.control_host}({lkp.control_addr})"
     slurmd_options = [
-        f'--conf-server="{slurmctld_host}:{lkp.control_host_port}"',
+        f'--conf-server="{_slurmctld_host(lkp)}:{lkp.control_host_port}"',
     ]
 
     try:
@@ -531,9 +637,8 @@ def setup_compute():
     setup_nss_slurm()
     setup_network_storage()
 
-    has_gpu = run("lspci | grep --ignore-case 'NVIDIA' | wc -l", shell=True).returncode
-    if has_gpu:
-        run("nvidia-smi")
+    if _has_nvidia_gpu():
+        run("nvidia-smi", timeout=60, check=False)
 
     run_custom_scripts()
 
@@ -545,9 +650,10 @@ def setup_compute():
     run("systemctl enable --now slurmcmd.timer", timeout=30)
 
     log.info("Check status of cluster services")
+    services = "slurmd"
     if not lkp.cfg.enable_slurm_auth:
-      run("systemctl status munge", timeout=30)
-    run("systemctl status slurmd", timeout=30)
+      services = f"munge {services}"
+    run(f"systemctl status {services}", timeout=30)
 
     log.info("Done setting up compute")
 
@@ -560,8 +666,10 @@ def setup_cloud_ops() -> None:
     if cloudOpsStatus != 0:
         return
 
+    lkp = lookup()
+
     with open("/etc/google-cloud-ops-agent/config.yaml", "r") as f:
-        file = yaml.safe_load(f)
+        file = yaml.load(f, Loader=SafeLoader)
 
     # Update setup receiver path
     file["logging"]["receivers"]["setup"]["include_paths"] = ["/var/log/slurm/setup.log"]
@@ -577,10 +685,10 @@ def setup_cloud_ops() -> None:
         'type':'modify_fields',
         'fields': {
             'labels."cluster_name"':{
-                'static_value':f"{lookup().cfg.slurm_cluster_name}"
+                'static_value':f"{lkp.cfg.slurm_cluster_name}"
             },
             'labels."hostname"':{
-                'static_value': f"{lookup().hostname}"
+                'static_value': f"{lkp.hostname}"
             }
         }
     }
@@ -595,7 +703,7 @@ def setup_cloud_ops() -> None:
     )
 
     with open("/etc/google-cloud-ops-agent/config.yaml", "w") as f:
-        yaml.safe_dump(file, f, sort_keys=False)
+        yaml.dump(file, f, Dumper=SafeDumper, sort_keys=False)
 
     run("systemctl restart google-cloud-ops-agent.service", timeout=90)
 
@@ -604,28 +712,32 @@ def main():
     start_motd()
 
     log.info("Starting setup, fetching config")
-    sleep_seconds = 5
+    # exponential backoff with jitter, to not have all nodes hitting the bucket in lockstep
+    delay = 0.5
     while True:
+        sleep_seconds = delay + random.uniform(0, delay / 2)
         try:
             _, cfg = util.fetch_config()
             util.update_config(cfg)
             break
         except util.DeffetiveStoredConfigError as e:
-            log.warning(f"config is not ready yet: {e}, sleeping for {sleep_seconds}s")
+            log.warning(f"config is not ready yet: {e}, sleeping for {sleep_seconds:.1f}s")
         except Exception as e:
-            log.exception(f"unexpected error while fetching config, sleeping for {sleep_seconds}s")
+            log.exception(f"unexpected error while fetching config, sleeping for {sleep_seconds:.1f}s")
         time.sleep(sleep_seconds)
+        delay = min(delay * 2, 30)
     log.info("Config fetched")
     setup_cloud_ops()
     configure_dirs()
     # call the setup function for the instance type
+    role = lookup().instance_role
     {
         "controller": setup_controller,
         "compute": setup_compute,
         "login": setup_login,
     }.get(
-        lookup().instance_role,
-        lambda: log.fatal(f"Unknown node role: {lookup().instance_role}"))()
+        role,
+        lambda: log.fatal(f"Unknown node role: {role}"))()
 
     end_motd()
 
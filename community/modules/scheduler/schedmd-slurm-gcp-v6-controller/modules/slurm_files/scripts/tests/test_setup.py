@@ -0,0 +1,85 @@
+# Copyright 2024 "Google LLC"
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from common import TstCfg # needed to import util
+import setup
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("passwd:     files sss\n", "passwd:     slurm files sss\n"),
+        ("passwd: slurm files\n", "passwd: slurm files\n"),
+        ("passwd:\ngroup: files\n", "passwd:\ngroup: slurm files\n"),
+        ("shadow: files\n", "shadow: files\n"),
+    ],
+)
+def test_nss_slurm_re(text, expected):
+    got = setup._NSS_SLURM_RE.sub(r"\1slurm ", text)
+    assert got == expected
+    # second run must not change anything
+    assert setup._NSS_SLURM_RE.sub(r"\1slurm ", got) == got
+
+
+def test_iter_scripts_matches_rglob(tmp_path):
+    for d in ("b", "a", "d", "c"):
+        (tmp_path / d / "sub").mkdir(parents=True)
+        (tmp_path / d / "run.sh").touch()
+        (tmp_path / d / "sub" / "run.sh").touch()
+    (tmp_path / "top.sh").touch()
+    (tmp_path / "a" / "off.sh.disabled").touch()
+
+    expected = [
+        p for p in tmp_path.rglob("*")
+        if p.is_file() and not p.name.endswith(".disabled")
+    ]
+    assert list(setup._iter_scripts(tmp_path)) == expected
+    assert list(setup._iter_scripts(tmp_path / "missing")) == []
+
+
+@pytest.mark.parametrize(
+    "content,entries,added,expected",
+    [
+        ("/dev/a /x ext4 defaults 0 0\n", ["/dev/b /y ext4 defaults 0 0"], True,
+         "/dev/a /x ext4 defaults 0 0\n/dev/b /y ext4 defaults 0 0\n"),
+        # last line without newline
+        ("/dev/a /x ext4 defaults 0 0", ["/dev/b /y ext4 defaults 0 0"], True,
+         "/dev/a /x ext4 defaults 0 0\n/dev/b /y ext4 defaults 0 0\n"),
+        ("", ["/dev/b /y ext4 defaults 0 0"], True,
+         "/dev/b /y ext4 defaults 0 0\n"),
+        # already present with different spacing
+        ("/dev/b   /y\text4  defaults 0 0\n", ["/dev/b /y ext4 defaults 0 0"], False,
+         "/dev/b   /y\text4  defaults 0 0\n"),
+    ],
+)
+def test_ensure_fstab_entries(tmp_path, content, entries, added, expected):
+    fstab = tmp_path / "fstab"
+    fstab.write_text(content)
+    assert setup.ensure_fstab_entries(entries, fstab=fstab) == added
+    assert fstab.read_text() == expected
+    # idempotent
+    assert not setup.ensure_fstab_entries(entries, fstab=fstab)
+    assert fstab.read_text() == expected
+
+
+def test_atomic_write_keeps_mode(tmp_path):
+    p = tmp_path / "motd"
+    p.write_text("old")
+    p.chmod(0o640)
+    setup._atomic_write(p, "new")
+    assert p.read_text() == "new"
+    assert p.stat().st_mode & 0o777 == 0o640
+    assert not (tmp_path / "motd.tmp").exists()
@@ -18,6 +18,7 @@ import pytest
 from mock import Mock
 from datetime import datetime, timezone, timedelta
 import unittest
+import subprocess
 
 from common import TstNodeset, TstCfg # needed to import util
 import util
@@ -584,3 +585,25 @@ def test_future_reservation_inactive(_):
     
     lkp._get_future_reservation.assert_called_once_with("manhattan", "danger", "zebra")
     lkp._get_reservation.assert_not_called()
+
+
+def test_run_parallel():
+    results = util.run_parallel(["echo a", "echo b", "true"], max_workers=2)
+    assert [r.stdout for r in results] == ["a\n", "b\n", ""]
+
+    with pytest.raises(subprocess.CalledProcessError):
+        util.run_parallel(["true", "false"])
+
+
+def test_chown_slurm_creates_and_chmods(tmp_path):
+    p = tmp_path / "sub" / "key"
+    util.chown_slurm(p, mode=0o600)
+    assert p.is_file()
+    assert p.stat().st_mode & 0o777 == 0o600
+
+    util.chown_slurm(p, mode=0o400)
+    assert p.stat().st_mode & 0o777 == 0o400
+
+    q = tmp_path / "other" / "file"
+    util.chown_slurm(q)
+    assert q.is_file()
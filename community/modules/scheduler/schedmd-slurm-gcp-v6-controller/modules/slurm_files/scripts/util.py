@@ -25,8 +25,10 @@ import json
 import logging
 import logging.config
 import logging.handlers
+import grp
 import math
 import os
+import pwd
 import re
 import shlex
 import shutil
@@ -950,6 +952,12 @@ def run(
     log_subprocess(result)
     return result
 
+
+def run_parallel(cmds: Iterable[str], max_workers: int = 4, timeout=30) -> List[subprocess.CompletedProcess]:
+    """Run independent commands concurrently, raises first failure once all are done"""
+    with ThreadPoolExecutor(max_workers=max_workers) as exe:
+        return list(exe.map(lambda cmd: run(cmd, timeout=timeout), cmds))
+
 def log_subprocess(subj: subprocess.CalledProcessError | subprocess.TimeoutExpired | subprocess.CompletedProcess) -> None:
     match subj:
         case subprocess.CompletedProcess(returncode=0):
@@ -983,18 +991,26 @@ def log_subprocess(subj: subprocess.CalledProcessError | subprocess.TimeoutExpir
         log.error(f"stderr: {stderr}")
 
 
+@lru_cache(maxsize=1)
+def _slurm_ids() -> Tuple[int, int]:
+    """uid and gid of slurm, resolved once rather than through NSS on every chown"""
+    # KeyError (a LookupError) if missing, not cached so it's retried next time
+    return pwd.getpwnam("slurm").pw_uid, grp.getgrnam("slurm").gr_gid
+
+
 def chown_slurm(path: Path, mode=None) -> None:
-    if path.exists():
-        if mode:
+    if mode:
+        # chmod doubles as the existence check, saves a stat on the common path
+        try:
             path.chmod(mode)
-    else:
-        mkdirp(path.parent)
-        if mode:
+        except FileNotFoundError:
+            mkdirp(path.parent)
             path.touch(mode=mode)
-        else:
-            path.touch()
+    elif not path.exists():
+        mkdirp(path.parent)
+        path.touch()
     try:
-        shutil.chown(path, user="slurm", group="slurm")
+        os.chown(path, *_slurm_ids())
     except LookupError:
         log.warning(f"User 'slurm' does not exist. Cannot 'chown slurm:slurm {path}'.")
     except PermissionError:
@@ -1167,12 +1183,17 @@ ROOT_URL = "http://metadata.google.internal/computeMetadata/v1"
 class MetadataNotFoundError(Exception):
     pass
 
+@lru_cache(maxsize=1)
+def _metadata_session() -> requests_lib.Session:
+    """Shared session, keeps the connection to the metadata server alive between calls"""
+    return requests_lib.Session()
+
 def get_metadata(path, root=ROOT_URL):
     """Get metadata relative to metadata/computeMetadata/v1"""
     HEADERS = {"Metadata-Flavor": "Google"}
     url = f"{root}/{path}"
     try:
-        resp = requests_lib.get(url, headers=HEADERS)
+        resp = _metadata_session().get(url, headers=HEADERS)
         resp.raise_for_status()
         return resp.text
     except requests_lib.exceptions.HTTPError: